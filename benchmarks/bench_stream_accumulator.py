@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""
+Compare peak memory and CPU time of folding a long synthetic stream with
+StreamAccumulator against the previous retain-then-combine approach.
+
+    python benchmarks/bench_stream_accumulator.py --chunks 50000
+"""
+import argparse
+import time
+import tracemalloc
+
+from openai.types.chat import ChatCompletionChunk
+
+from llm_perplexity import StreamAccumulator
+
+CITATIONS = [f"https://example.com/{i}" for i in range(10)]
+
+
+def synthetic_stream(count, chunk_size):
+    text = ("x" * (chunk_size - 1)) + " "
+    for i in range(count):
+        last = i == count - 1
+        chunk = {
+            "id": "bench",
+            "object": "chat.completion.chunk",
+            "model": "sonar",
+            "created": 1700000000,
+            "citations": CITATIONS,
+            "choices": [{
+                "index": 0,
+                "delta": {"role": "assistant", "content": text},
+                "finish_reason": "stop" if last else None,
+            }],
+        }
+        if last:
+            chunk["usage"] = {"prompt_tokens": 10, "completion_tokens": count, "total_tokens": count + 10}
+        yield ChatCompletionChunk.model_validate(chunk)
+
+
+def legacy_combine_chunks(chunks):
+    """combine_chunks as it was before StreamAccumulator, for comparison."""
+    content = ""
+    role = None
+    finish_reason = None
+    usage = {}
+    citations = {}
+    for item in chunks:
+        if item.usage:
+            usage = item.usage.model_dump()
+        if getattr(item, "citations", None):
+            citations = item.citations
+        for choice in item.choices:
+            role = choice.delta.role
+            if choice.delta.content is not None:
+                content += choice.delta.content
+            if choice.finish_reason is not None:
+                finish_reason = choice.finish_reason
+    return {"content": content, "role": role, "finish_reason": finish_reason,
+            "usage": usage, "citations": citations}
+
+
+def run_legacy(count, chunk_size):
+    chunks = []
+    for chunk in synthetic_stream(count, chunk_size):
+        chunks.append(chunk)
+    return legacy_combine_chunks(chunks)
+
+
+def run_accumulator(count, chunk_size):
+    accumulator = StreamAccumulator()
+    for chunk in synthetic_stream(count, chunk_size):
+        accumulator.add(chunk)
+    return accumulator.result()
+
+
+def measure(fn, count, chunk_size):
+    # Time without tracemalloc, whose per-allocation hooks dominate CPU
+    start = time.process_time()
+    result = fn(count, chunk_size)
+    cpu = time.process_time() - start
+    tracemalloc.start()
+    fn(count, chunk_size)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, cpu, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--chunks", type=int, default=50000)
+    parser.add_argument("--chunk-size", type=int, default=4)
+    args = parser.parse_args()
+
+    legacy, legacy_cpu, legacy_peak = measure(run_legacy, args.chunks, args.chunk_size)
+    current, current_cpu, current_peak = measure(run_accumulator, args.chunks, args.chunk_size)
+    assert legacy["content"] == current["content"]
+
+    print(f"{args.chunks} chunks of {args.chunk_size} chars")
+    print(f"{'':<18}{'cpu (s)':>10}{'peak (MiB)':>14}")
+    print(f"{'retain + combine':<18}{legacy_cpu:>10.2f}{legacy_peak / 2**20:>14.1f}")
+    print(f"{'StreamAccumulator':<18}{current_cpu:>10.2f}{current_peak / 2**20:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,45 @@
+import asyncio
+import atexit
+import base64
+import contextlib
+import csv
+import email.utils
+import hashlib
+import importlib.util
+import io
+import json
+import math
+import mimetypes
+import os
+import random
+import sqlite3
+import threading
+import time
+import weakref
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
 import llm
 from llm.utils import (
     remove_dict_none_values,
     simplify_usage_dict,
 )
-from openai import OpenAI
+from openai import (
+    APIConnectionError,
+    AsyncOpenAI,
+    DEFAULT_TIMEOUT,
+    InternalServerError,
+    OpenAI,
+    RateLimitError,
+)
 from pydantic import Field, field_validator, model_validator
 from typing import Optional, List, Dict, Literal
 
+try:
+    import httpx
+except ImportError:  # newer openai releases ship on httpx2
+    import httpx2 as httpx
+
 # Available models - Updated as of 2026-02-25
 # https://docs.perplexity.ai/models/model-cards
 MODELS = [
@@ -16,10 +49,243 @@ MODELS = [
     "sonar-reasoning-pro",
 ]
 
+class ClientPool:
+    """
+    Process-wide pool of OpenAI clients keyed by (api_key, base_url).
+
+    Every client owns an HTTP connection pool with keep-alive, so repeated
+    prompts against the same endpoint reuse open connections instead of
+    paying for a new TCP connection and TLS handshake each time.
+    """
+
+    def __init__(
+        self,
+        max_connections: Optional[int] = None,
+        max_keepalive_connections: Optional[int] = None,
+        keepalive_expiry: Optional[float] = None,
+        http2: Optional[bool] = None,
+    ):
+        env = os.environ.get
+        self.max_connections = max_connections or int(
+            env("LLM_PERPLEXITY_POOL_MAX_CONNECTIONS", 100)
+        )
+        self.max_keepalive_connections = max_keepalive_connections or int(
+            env("LLM_PERPLEXITY_POOL_MAX_KEEPALIVE", 20)
+        )
+        self.keepalive_expiry = keepalive_expiry or float(
+            env("LLM_PERPLEXITY_POOL_KEEPALIVE_EXPIRY", 60)
+        )
+        if http2 is None:
+            http2 = env("LLM_PERPLEXITY_POOL_HTTP2", "").lower() in ("1", "true", "yes")
+        self.http2 = http2
+        self._clients: Dict[tuple, OpenAI] = {}
+        # Async connections are bound to the event loop that opened them
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.connections_opened = 0
+
+    @property
+    def connections_reused(self) -> int:
+        return self.requests - self.connections_opened
+
+    def _limits(self):
+        return httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive_connections,
+            keepalive_expiry=self.keepalive_expiry,
+        )
+
+    def _check_http2(self):
+        if self.http2 and importlib.util.find_spec("h2") is None:
+            raise llm.ModelError(
+                "HTTP/2 support requires the h2 package. "
+                "Install it with: llm install h2"
+            )
+
+    def _record(self, opened: bool):
+        with self._lock:
+            self.requests += 1
+            if opened:
+                self.connections_opened += 1
+
+    def _on_request(self, request):
+        # httpcore reports connection setup through the "trace" extension,
+        # so a request that sends headers without connecting reused a socket
+        opened = []
+
+        def trace(event_name, info):
+            if event_name == "connection.connect_tcp.started":
+                opened.append(True)
+            elif event_name.endswith(".send_request_headers.started"):
+                self._record(bool(opened))
+                opened.clear()
+
+        request.extensions["trace"] = trace
+
+    async def _on_async_request(self, request):
+        opened = []
+
+        async def trace(event_name, info):
+            if event_name == "connection.connect_tcp.started":
+                opened.append(True)
+            elif event_name.endswith(".send_request_headers.started"):
+                self._record(bool(opened))
+                opened.clear()
+
+        request.extensions["trace"] = trace
+
+    def get_client(self, api_key: str, base_url: str) -> OpenAI:
+        key = (api_key, base_url)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                self._check_http2()
+                http_client = httpx.Client(
+                    limits=self._limits(),
+                    http2=self.http2,
+                    timeout=DEFAULT_TIMEOUT,
+                    follow_redirects=True,
+                    event_hooks={"request": [self._on_request]},
+                )
+                # Retries are handled by execute so they can be counted
+                # and never replay a stream that has already started
+                client = OpenAI(
+                    api_key=api_key, base_url=base_url, http_client=http_client,
+                    max_retries=0,
+                )
+                self._clients[key] = client
+        return client
+
+    def get_async_client(self, api_key: str, base_url: str) -> AsyncOpenAI:
+        loop = asyncio.get_running_loop()
+        key = (api_key, base_url)
+        with self._lock:
+            clients = self._async_clients.setdefault(loop, {})
+            client = clients.get(key)
+            if client is None:
+                self._check_http2()
+                http_client = httpx.AsyncClient(
+                    limits=self._limits(),
+                    http2=self.http2,
+                    timeout=DEFAULT_TIMEOUT,
+                    follow_redirects=True,
+                    event_hooks={"request": [self._on_async_request]},
+                )
+                client = AsyncOpenAI(
+                    api_key=api_key, base_url=base_url, http_client=http_client,
+                    max_retries=0,
+                )
+                clients[key] = client
+        return client
+
+    async def aclose(self):
+        """Close the async clients bound to the running event loop."""
+        with self._lock:
+            clients = self._async_clients.pop(asyncio.get_running_loop(), {})
+        for client in clients.values():
+            await client.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "clients": len(self._clients) + sum(
+                    len(clients) for clients in self._async_clients.values()
+                ),
+                "requests": self.requests,
+                "connections_opened": self.connections_opened,
+                "connections_reused": self.connections_reused,
+            }
+
+    def close(self):
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+        for client in clients:
+            client.close()
+        # Async clients can only be closed from their own event loop; once
+        # the pool lets go of them their connections close with the loop
+        with self._lock:
+            self._async_clients.clear()
+
+
+_client_pool = ClientPool()
+
+
+def get_client_pool() -> ClientPool:
+    return _client_pool
+
+
+def configure_client_pool(**settings) -> ClientPool:
+    """Replace the shared client pool, closing the connections of the old one."""
+    global _client_pool
+    old_pool, _client_pool = _client_pool, ClientPool(**settings)
+    old_pool.close()
+    return _client_pool
+
+
+@atexit.register
+def _close_client_pool():
+    _client_pool.close()
+
+
 @llm.hookimpl
 def register_models(register):
     for model_id in MODELS:
-        register(Perplexity(model_id))
+        register(Perplexity(model_id), AsyncPerplexity(model_id))
+
+@llm.hookimpl
+def register_commands(cli):
+    import click
+
+    @cli.group()
+    def perplexity():
+        "Commands for working with Perplexity models"
+
+    @perplexity.command()
+    @click.argument("input_path", type=click.Path(exists=True, dir_okay=False))
+    @click.argument("output_path", type=click.Path(dir_okay=False))
+    @click.option("-m", "--model", "model_id", default="sonar", help="Default model for rows without a model")
+    @click.option(
+        "-o", "--option", "options", type=(str, str), multiple=True,
+        help="Default option for every row, e.g. -o search_mode academic",
+    )
+    @click.option("-c", "--concurrency", default=8, show_default=True, help="Maximum requests in flight")
+    @click.option("--format", "input_format", type=click.Choice(["jsonl", "csv"]), help="Input format, defaults to the file extension")
+    def batch(input_path, output_path, model_id, options, concurrency, input_format):
+        """
+        Run every prompt in a JSONL or CSV file, writing results to OUTPUT_PATH
+
+        Each row needs a "prompt" and can set "model", "system" and any model
+        option. Results are appended as JSON lines in completion order with the
+        row "index"; re-running skips rows that already have a result.
+        """
+        rows = read_batch_rows(input_path, input_format)
+        summary = asyncio.run(
+            run_batch(rows, output_path, model_id, dict(options), concurrency)
+        )
+        click.echo(
+            "{completed} completed, {failed} failed, {skipped} skipped in {elapsed:.1f}s "
+            "({throughput:.2f} req/s, latency p50 {p50_ms:.0f}ms p95 {p95_ms:.0f}ms "
+            "max {max_ms:.0f}ms)".format(**summary),
+            err=True,
+        )
+
+
+    @perplexity.group()
+    def cache():
+        "Manage the Perplexity response cache"
+
+    @cache.command(name="stats")
+    def cache_stats():
+        "Show response cache size and hit rate"
+        click.echo(json.dumps(get_response_cache().stats(), indent=2))
+
+    @cache.command(name="clear")
+    def cache_clear():
+        "Delete every cached response"
+        get_response_cache().clear()
+
 
 class PerplexityOptions(llm.Options):
     max_tokens: Optional[int] = Field(
@@ -113,7 +379,12 @@ class PerplexityOptions(llm.Options):
     )
 
     image_path: Optional[str] = Field(
-        description="Path to an image file to include in the request. The image will be encoded as base64 and sent along with the text prompt.",
+        description="Path to an image file to include in the request, or a comma-separated list of paths. Images are encoded as base64 and sent along with the text prompt.",
+        default=None,
+    )
+
+    image_max_size: Optional[int] = Field(
+        description="Downscale and recompress images whose width or height exceeds this many pixels before sending them. Requires Pillow.",
         default=None,
     )
 
@@ -122,6 +393,66 @@ class PerplexityOptions(llm.Options):
         default=True,
     )
 
+    history: Optional[Literal["full", "window", "summarize"]] = Field(
+        description="How much conversation history to send: 'full' replays every turn, 'window' keeps the most recent turns within history_max_tokens, 'summarize' also replaces older turns with a cached summary.",
+        default=None,
+    )
+
+    history_max_tokens: Optional[int] = Field(
+        description="Estimated token budget for replayed conversation turns when history is 'window' or 'summarize'.",
+        default=4000,
+    )
+
+    requests_per_minute: Optional[int] = Field(
+        description="Client-side request rate limit per model and endpoint, shared across threads and async tasks. Defaults to the LLM_PERPLEXITY_RPM environment variable.",
+        default=None,
+    )
+
+    tokens_per_minute: Optional[int] = Field(
+        description="Client-side estimated token rate limit per model and endpoint. Defaults to the LLM_PERPLEXITY_TPM environment variable.",
+        default=None,
+    )
+
+    max_retries: Optional[int] = Field(
+        description="Retries for rate-limited (429), server error (5xx) and connection failures, with jittered exponential backoff honouring Retry-After. A stream is never retried once it has started.",
+        default=2,
+    )
+
+    hedge: Optional[bool] = Field(
+        description="Send a second identical request if the first has not answered (or streamed its first chunk) within the hedge delay, and use whichever finishes first.",
+        default=None,
+    )
+
+    hedge_delay: Optional[float] = Field(
+        description="Seconds to wait before hedging. Defaults to the hedge_percentile of recently observed latencies.",
+        default=None,
+    )
+
+    hedge_percentile: Optional[float] = Field(
+        description="Observed latency percentile used as the hedge delay when hedge_delay is not set.",
+        default=95,
+    )
+
+    hedge_max_rate: Optional[float] = Field(
+        description="Maximum fraction of requests that may be hedged, bounding the extra cost.",
+        default=0.1,
+    )
+
+    cache: Optional[bool] = Field(
+        description="Serve identical requests from the on-disk response cache. Defaults to the LLM_PERPLEXITY_CACHE environment variable.",
+        default=None,
+    )
+
+    no_cache: Optional[bool] = Field(
+        description="Bypass the response cache for this request, neither reading nor writing it.",
+        default=None,
+    )
+
+    cache_ttl: Optional[int] = Field(
+        description="Seconds a cached response stays fresh. Defaults to a TTL derived from search_recency_filter.",
+        default=None,
+    )
+
     @field_validator("temperature")
     @classmethod
     def validate_temperature(cls, temperature):
@@ -166,12 +497,623 @@ class PerplexityOptions(llm.Options):
         return self
 
 
-class Perplexity(llm.Model):
+def plugin_db_path():
+    """SQLite database holding the plugin's local state."""
+    return llm.user_dir() / "perplexity.db"
+
+
+def connect_plugin_db(path=None) -> sqlite3.Connection:
+    db = sqlite3.connect(str(path or plugin_db_path()), timeout=30, isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    return db
+
+
+# How long a cached answer stays fresh, by search_recency_filter: a
+# question scoped to the last hour goes stale much faster than one
+# scoped to the last year
+CACHE_TTLS = {
+    "hour": 5 * 60,
+    "day": 60 * 60,
+    "week": 6 * 60 * 60,
+    "month": 24 * 60 * 60,
+    "year": 7 * 24 * 60 * 60,
+}
+DEFAULT_CACHE_TTL = 60 * 60
+
+
+def cache_ttl_for(options) -> int:
+    return CACHE_TTLS.get(options.search_recency_filter, DEFAULT_CACHE_TTL)
+
+
+class ResponseCache:
+    """
+    On-disk cache of finished responses keyed by a hash of the request.
+
+    Entries expire after their TTL and the least recently used entries are
+    evicted once the cache grows past ``max_entries`` or ``max_bytes``.
+    """
+
+    def __init__(self, path=None, max_entries: Optional[int] = None, max_bytes: Optional[int] = None):
+        self.path = path or plugin_db_path()
+        self.max_entries = max_entries or int(
+            os.environ.get("LLM_PERPLEXITY_CACHE_MAX_ENTRIES", 10000)
+        )
+        self.max_bytes = max_bytes or int(
+            float(os.environ.get("LLM_PERPLEXITY_CACHE_MAX_MB", 256)) * 2**20
+        )
+        self._lock = threading.Lock()
+        with self._connect() as db:
+            db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS response_cache (
+                    key TEXT PRIMARY KEY, value TEXT, size INTEGER,
+                    created REAL, expires REAL, last_used REAL
+                )
+                """
+            )
+            db.execute("CREATE TABLE IF NOT EXISTS cache_stats (name TEXT PRIMARY KEY, value INTEGER)")
+
+    def _connect(self):
+        return contextlib.closing(connect_plugin_db(self.path))
+
+    @staticmethod
+    def key(kwargs: dict) -> str:
+        """Canonical hash of the request kwargs; streaming and non-streaming share entries."""
+        request = {k: v for k, v in kwargs.items() if k != "stream"}
+        canonical = json.dumps(request, sort_keys=True, separators=(",", ":"), default=str)
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def _count(self, db, name):
+        db.execute(
+            "INSERT INTO cache_stats VALUES (?, 1) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + 1",
+            (name,),
+        )
+
+    def get(self, key: str) -> Optional[dict]:
+        now = time.time()
+        with self._lock, self._connect() as db:
+            row = db.execute(
+                "SELECT value, created FROM response_cache WHERE key = ? AND expires > ?",
+                (key, now),
+            ).fetchone()
+            if row is None:
+                self._count(db, "misses")
+                return None
+            db.execute("UPDATE response_cache SET last_used = ? WHERE key = ?", (now, key))
+            self._count(db, "hits")
+        entry = json.loads(row[0])
+        entry["age"] = now - row[1]
+        return entry
+
+    def set(self, key: str, entry: dict, ttl: int):
+        value = json.dumps(entry)
+        now = time.time()
+        with self._lock, self._connect() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO response_cache VALUES (?, ?, ?, ?, ?, ?)",
+                (key, value, len(value), now, now + ttl, now),
+            )
+            self._evict(db, now)
+
+    def _evict(self, db, now):
+        db.execute("DELETE FROM response_cache WHERE expires <= ?", (now,))
+        db.execute(
+            "DELETE FROM response_cache WHERE key IN (SELECT key FROM response_cache "
+            "ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+        db.execute(
+            "DELETE FROM response_cache WHERE key IN (SELECT key FROM ("
+            "SELECT key, SUM(size) OVER (ORDER BY last_used DESC, key) AS running "
+            "FROM response_cache) WHERE running > ?)",
+            (self.max_bytes,),
+        )
+
+    def stats(self) -> dict:
+        with self._lock, self._connect() as db:
+            counts = dict(db.execute("SELECT name, value FROM cache_stats").fetchall())
+            entries, size = db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM response_cache WHERE expires > ?",
+                (time.time(),),
+            ).fetchone()
+        hits, misses = counts.get("hits", 0), counts.get("misses", 0)
+        return {
+            "entries": entries,
+            "bytes": size,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+        }
+
+    def clear(self):
+        with self._lock, self._connect() as db:
+            db.execute("DELETE FROM response_cache")
+            db.execute("DELETE FROM cache_stats")
+
+
+_response_cache = None
+
+
+def get_response_cache() -> ResponseCache:
+    global _response_cache
+    if _response_cache is None or _response_cache.path != plugin_db_path():
+        _response_cache = ResponseCache()
+    return _response_cache
+
+
+def estimate_tokens(text: Optional[str]) -> int:
+    """Rough token count, about four characters per token."""
+    return len(text or "") // 4 + 1
+
+
+def estimate_request_tokens(kwargs: dict) -> int:
+    """Rough token cost of a request: its text content plus max_tokens."""
+    tokens = 0
+    for message in kwargs["messages"]:
+        content = message["content"]
+        if isinstance(content, list):
+            content = " ".join(part.get("text", "") for part in content)
+        tokens += estimate_tokens(content)
+    return tokens + (kwargs.get("max_tokens") or 0)
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket refilled continuously at ``rate`` per minute.
+
+    ``reserve`` takes the tokens immediately, going into debt if needed, and
+    returns how long the caller should wait before sending. Callers sleep
+    outside the lock, with time.sleep or asyncio.sleep, so the same bucket
+    can be shared by threads and async tasks.
+    """
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float = 1) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / 60)
+            self.updated = now
+            self.tokens -= amount
+            return max(0.0, -self.tokens * 60 / self.rate)
+
+
+class RateLimiter:
+    """Requests-per-minute and tokens-per-minute buckets for one model and endpoint."""
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+
+    def reserve(self, tokens: int) -> float:
+        waits = [0.0]
+        if self.requests:
+            waits.append(self.requests.reserve(1))
+        if self.tokens:
+            waits.append(self.tokens.reserve(tokens))
+        return max(waits)
+
+
+_rate_limiters: Dict[tuple, RateLimiter] = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(base_url: str, model_id: str, options) -> Optional[RateLimiter]:
+    rpm = options.requests_per_minute or int(os.environ.get("LLM_PERPLEXITY_RPM", 0))
+    tpm = options.tokens_per_minute or int(os.environ.get("LLM_PERPLEXITY_TPM", 0))
+    if not rpm and not tpm:
+        return None
+    key = (base_url, model_id, rpm, tpm)
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(key)
+        if limiter is None:
+            limiter = _rate_limiters[key] = RateLimiter(rpm, tpm)
+    return limiter
+
+
+HEDGE_DEFAULT_DELAY = 3.0
+HEDGE_DEFAULT_PERCENTILE = 95
+HEDGE_MIN_SAMPLES = 20
+
+
+class HedgeState:
+    """Recent latencies and hedge counts for one model and endpoint."""
+
+    def __init__(self, window: int = 200):
+        self.latencies = deque(maxlen=window)
+        self.requests = 0
+        self.hedges = 0
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float):
+        with self._lock:
+            self.latencies.append(seconds)
+
+    def percentile(self, pct: float) -> Optional[float]:
+        with self._lock:
+            if len(self.latencies) < HEDGE_MIN_SAMPLES:
+                return None
+            return percentile(list(self.latencies), pct)
+
+    def record_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def try_hedge(self, max_rate: Optional[float]) -> bool:
+        """Take a hedge if that keeps hedges within max_rate of all requests."""
+        with self._lock:
+            if self.hedges + 1 > (max_rate or 0) * self.requests:
+                return False
+            self.hedges += 1
+            return True
+
+    @property
+    def hedge_rate(self) -> float:
+        return self.hedges / self.requests if self.requests else 0.0
+
+
+_hedge_states: Dict[tuple, HedgeState] = {}
+_hedge_states_lock = threading.Lock()
+
+
+def get_hedge_state(base_url: str, model_id: str) -> HedgeState:
+    with _hedge_states_lock:
+        return _hedge_states.setdefault((base_url, model_id), HedgeState())
+
+
+class _PrefetchedStream:
+    """A stream whose first chunk has already been read."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._chunks = iter(stream)
+        self.first = next(self._chunks, None)
+
+    def __iter__(self):
+        if self.first is not None:
+            yield self.first
+        yield from self._chunks
+
+    def close(self):
+        self.stream.close()
+
+
+class _AsyncPrefetchedStream:
+    """An async stream whose first chunk has already been read."""
+
+    def __init__(self, stream, first):
+        self.stream = stream
+        self.first = first
+
+    @classmethod
+    async def start(cls, stream):
+        try:
+            first = await stream.__anext__()
+        except StopAsyncIteration:
+            first = None
+        return cls(stream, first)
+
+    async def __aiter__(self):
+        if self.first is not None:
+            yield self.first
+        async for chunk in self.stream:
+            yield chunk
+
+    async def close(self):
+        await self.stream.close()
+
+
+def _close_attempt(future):
+    if not future.exception() and isinstance(future.result(), _PrefetchedStream):
+        future.result().close()
+
+
+# Failures worth retrying: rate limits, server errors and connection
+# problems (which include timeouts)
+RETRYABLE_ERRORS = (RateLimitError, InternalServerError, APIConnectionError)
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 30.0
+
+
+def retry_delay(error, attempt: int) -> float:
+    """Seconds to wait before retry number ``attempt`` (from 0) after ``error``."""
+    response = getattr(error, "response", None)
+    headers = response.headers if response is not None else {}
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    if headers.get("retry-after"):
+        try:
+            return float(headers["retry-after"])
+        except ValueError:
+            retry_at = email.utils.parsedate_to_datetime(headers["retry-after"])
+            if retry_at is not None:
+                return max(0.0, retry_at.timestamp() - time.time())
+    # Full jitter keeps concurrent clients from retrying in lockstep
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2**attempt))
+
+
+HISTORY_SUMMARY_MODEL = "sonar"
+HISTORY_SUMMARY_MAX_TOKENS = 500
+HISTORY_SUMMARY_PROMPT = (
+    "Summarize this conversation between a user and an assistant in a few "
+    "short paragraphs. Keep names, numbers, decisions and open questions "
+    "that later turns may refer to."
+)
+
+
+class SummaryStore:
+    """Conversation summaries keyed by conversation id and turns covered."""
+
+    def __init__(self, path=None):
+        self.path = path or plugin_db_path()
+        with contextlib.closing(connect_plugin_db(self.path)) as db:
+            db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS history_summaries (
+                    conversation_id TEXT, turns INTEGER, summary TEXT,
+                    PRIMARY KEY (conversation_id, turns)
+                )
+                """
+            )
+
+    def latest(self, conversation_id: str, max_turns: int):
+        """Return (turns, summary) for the longest summary covering at most max_turns."""
+        with contextlib.closing(connect_plugin_db(self.path)) as db:
+            row = db.execute(
+                "SELECT turns, summary FROM history_summaries "
+                "WHERE conversation_id = ? AND turns <= ? ORDER BY turns DESC LIMIT 1",
+                (conversation_id, max_turns),
+            ).fetchone()
+        return row or (0, None)
+
+    def save(self, conversation_id: str, turns: int, summary: str):
+        with contextlib.closing(connect_plugin_db(self.path)) as db:
+            db.execute(
+                "INSERT OR REPLACE INTO history_summaries VALUES (?, ?, ?)",
+                (conversation_id, turns, summary),
+            )
+
+
+_summary_store = None
+
+
+def get_summary_store() -> SummaryStore:
+    global _summary_store
+    if _summary_store is None or _summary_store.path != plugin_db_path():
+        _summary_store = SummaryStore()
+    return _summary_store
+
+
+class ImageCache:
+    """
+    LRU cache of base64-encoded images keyed by (path, mtime, size, max_size).
+
+    Re-sending the same file, including on every turn of a conversation,
+    skips reading, resizing and encoding it again until the file changes.
+    """
+
+    def __init__(self, max_bytes: Optional[int] = None):
+        self.max_bytes = max_bytes or int(
+            float(os.environ.get("LLM_PERPLEXITY_IMAGE_CACHE_MB", 64)) * 2**20
+        )
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def encode(self, path: str, max_size: Optional[int] = None) -> dict:
+        """Return the data URL and byte counts for one image."""
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size, max_size)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return dict(entry, cached=True)
+
+        with open(path, "rb") as img_file:
+            data = img_file.read()
+        mime_type, _ = mimetypes.guess_type(path)
+        if not mime_type or not mime_type.startswith("image/"):
+            mime_type = "image/png"
+        resized = max_size and _downscale_image(data, max_size)
+        if resized:
+            data, mime_type = resized
+        url = f"data:{mime_type};base64,{base64.b64encode(data).decode('utf-8')}"
+        entry = {
+            "url": url,
+            "path": path,
+            "bytes": stat.st_size,
+            "encoded_bytes": len(url),
+            "resized": bool(resized),
+        }
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = entry
+                self._size += len(url)
+            while self._size > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted["url"])
+        return dict(entry, cached=False)
+
+    def encode_many(self, paths: List[str], max_size: Optional[int] = None) -> List[dict]:
+        """Encode several images, in parallel when there is more than one."""
+        if len(paths) == 1:
+            return [self.encode(paths[0], max_size)]
+        with ThreadPoolExecutor(max_workers=min(len(paths), 8)) as executor:
+            return list(executor.map(lambda path: self.encode(path, max_size), paths))
+
+
+def _downscale_image(data: bytes, max_size: int):
+    """Shrink an image to fit in max_size pixels, returning (bytes, mime) or None."""
+    try:
+        from PIL import Image
+    except ImportError:
+        raise llm.ModelError(
+            "image_max_size requires Pillow. Install it with: llm install pillow"
+        )
+    with Image.open(io.BytesIO(data)) as img:
+        if max(img.size) <= max_size:
+            return None
+        img.thumbnail((max_size, max_size))
+        out = io.BytesIO()
+        if img.mode in ("RGBA", "LA", "P"):
+            img.save(out, "PNG", optimize=True)
+            return out.getvalue(), "image/png"
+        img.convert("RGB").save(out, "JPEG", quality=85, optimize=True)
+        return out.getvalue(), "image/jpeg"
+
+
+_image_cache = ImageCache()
+
+
+def get_image_cache() -> ImageCache:
+    return _image_cache
+
+
+def build_extra_body(options) -> dict:
+    """
+    Map Perplexity-specific options onto the request's extra_body.
+
+    These parameters go in extra_body since the openai client rejects
+    non-standard kwargs.
+    """
+    extra = {}
+
+    if options.top_k:
+        extra["top_k"] = options.top_k
+
+    # Search parameters
+    if options.search_recency_filter:
+        extra["search_recency_filter"] = options.search_recency_filter
+
+    if options.search_domain_filter:
+        domains = [d.strip() for d in options.search_domain_filter.split(",") if d.strip()]
+        if domains:
+            extra["search_domain_filter"] = ",".join(domains)
+
+    if options.search_type:
+        extra["web_search_options"] = {"search_type": options.search_type}
+
+    if options.search_mode:
+        extra["search_mode"] = options.search_mode
+
+    if options.disable_search:
+        extra["disable_search"] = options.disable_search
+
+    if options.search_language_filter:
+        extra["search_language_filter"] = options.search_language_filter
+
+    # Generation parameters
+    if options.reasoning_effort:
+        extra["reasoning_effort"] = options.reasoning_effort
+
+    if options.return_images:
+        extra["return_images"] = options.return_images
+
+    if options.return_related_questions:
+        extra["return_related_questions"] = options.return_related_questions
+
+    if options.language_preference:
+        extra["language_preference"] = options.language_preference
+
+    return extra
+
+
+class StreamAccumulator:
+    """
+    Fold streamed chunks into the combined response dict as they arrive.
+
+    Only the pieces of each chunk that end up in ``response_json`` are kept:
+    content fragments go into a join buffer, and usage and citations keep
+    their latest value, so the raw chunk objects can be released immediately.
+    """
+
+    def __init__(self):
+        self._content = []
+        self.role = None
+        self.finish_reason = None
+        self.logprobs = []
+        self.usage = {}
+        self.citations = {}
+        self.metadata = None
+
+    def add(self, item) -> Optional[str]:
+        """Fold in one chunk, returning the content delta of its first choice."""
+        if self.metadata is None:
+            self.metadata = {}
+            for key in ("id", "object", "model", "created", "index"):
+                value = getattr(item, key, None)
+                if value is not None:
+                    self.metadata[key] = value
+
+        if hasattr(item, "usage") and item.usage:
+            self.usage = item.usage.model_dump()
+
+        # Check for both search_results (new) and citations (legacy)
+        if hasattr(item, "search_results") and item.search_results:
+            self.citations = item.search_results
+        elif hasattr(item, "citations") and item.citations:
+            self.citations = item.citations
+
+        delta_content = None
+        for i, choice in enumerate(item.choices):
+            if choice.logprobs and hasattr(choice.logprobs, "top_logprobs"):
+                self.logprobs.append(
+                    {
+                        "text": choice.text if hasattr(choice, "text") else None,
+                        "top_logprobs": choice.logprobs.top_logprobs,
+                    }
+                )
+
+            if not hasattr(choice, "delta"):
+                self._content.append(choice.text)
+                continue
+            self.role = choice.delta.role
+            if choice.delta.content is not None:
+                self._content.append(choice.delta.content)
+                if i == 0:
+                    delta_content = choice.delta.content
+            if choice.finish_reason is not None:
+                self.finish_reason = choice.finish_reason
+        return delta_content
+
+    @property
+    def content(self) -> str:
+        return "".join(self._content)
+
+    def result(self) -> dict:
+        combined = {
+            "content": self.content,
+            "role": self.role,
+            "finish_reason": self.finish_reason,
+            "usage": self.usage,
+            "citations": self.citations,
+        }
+        if self.logprobs:
+            combined["logprobs"] = self.logprobs
+        if self.metadata:
+            combined.update(self.metadata)
+        return combined
+
+
+class _SharedPerplexity:
+    """Behaviour shared by the sync and async Perplexity models."""
+
     needs_key = "perplexity"
     key_env_var = "LLM_PERPLEXITY_KEY"
     model_id = "perplexity"
     can_stream = True
     base_url = "https://api.perplexity.ai"
+    openrouter_base_url = "https://openrouter.ai/api/v1"
 
     class Options(PerplexityOptions):
         use_openrouter: Optional[bool] = Field(
@@ -184,59 +1126,16 @@ class Perplexity(llm.Model):
 
     @staticmethod
     def combine_chunks(chunks: List) -> dict:
-        content = ""
-        role = None
-        finish_reason = None
-        logprobs = []
-        usage = {}
-        citations = {}
-
-        for item in chunks:
-            if hasattr(item, "usage") and item.usage:
-                usage = item.usage.model_dump()
-
-            # Check for both search_results (new) and citations (legacy)
-            if hasattr(item, "search_results") and item.search_results:
-                citations = item.search_results
-            elif hasattr(item, "citations") and item.citations:
-                citations = item.citations
-
-            for choice in item.choices:
-                if choice.logprobs and hasattr(choice.logprobs, "top_logprobs"):
-                    logprobs.append(
-                        {
-                            "text": choice.text if hasattr(choice, "text") else None,
-                            "top_logprobs": choice.logprobs.top_logprobs,
-                        }
-                    )
-
-                if not hasattr(choice, "delta"):
-                    content += choice.text
-                    continue
-                role = choice.delta.role
-                if choice.delta.content is not None:
-                    content += choice.delta.content
-                if choice.finish_reason is not None:
-                    finish_reason = choice.finish_reason
-
-        combined = {
-            "content": content,
-            "role": role,
-            "finish_reason": finish_reason,
-            "usage": usage,
-            "citations": citations,
-        }
-        if logprobs:
-            combined["logprobs"] = logprobs
-        if chunks:
-            for key in ("id", "object", "model", "created", "index"):
-                value = getattr(chunks[0], key, None)
-                if value is not None:
-                    combined[key] = value
-
-        return combined
-
-    def build_messages(self, prompt, conversation) -> List[dict]:
+        accumulator = StreamAccumulator()
+        for chunk in chunks:
+            accumulator.add(chunk)
+        return accumulator.result()
+
+    def build_messages(self, prompt, conversation, metadata=None) -> List[dict]:
+        """
+        Build the chat messages for a prompt. Details about how they were
+        built are added to ``metadata`` if a dict is passed.
+        """
         messages = []
 
         system_message = "\n".join(filter(None, (
@@ -245,57 +1144,125 @@ class Perplexity(llm.Model):
             if prompt.options.include_citations is False else None
         )))
 
-        if system_message:
-            messages.append({"role": "system", "content": system_message})
-
+        history = []
         if conversation:
-            for response in conversation.responses:
-                messages.extend(
+            turns = [
+                (response.prompt.prompt, response.text())
+                for response in conversation.responses
+            ]
+            summary, turns = self._compact_history(prompt, conversation, turns, metadata)
+            if summary:
+                system_message = "\n\n".join(filter(None, (
+                    system_message, f"Summary of the earlier conversation:\n{summary}"
+                )))
+            for user_text, assistant_text in turns:
+                history.extend(
                     [
-                        {
-                            "role": "user",
-                            "content": response.prompt.prompt,
-                        },
-                        {"role": "assistant", "content": response.text()},
+                        {"role": "user", "content": user_text},
+                        {"role": "assistant", "content": assistant_text},
                     ]
                 )
 
-        # Handle multi-modal input (text + image)
-        if prompt.options.image_path:
-            import base64
-            import mimetypes
-
-            image_path = prompt.options.image_path
-            mime_type, _ = mimetypes.guess_type(image_path)
-            if not mime_type or not mime_type.startswith('image/'):
-                mime_type = 'image/png'
+        if system_message:
+            messages.append({"role": "system", "content": system_message})
+        messages.extend(history)
 
+        # Handle multi-modal input (text + images)
+        if prompt.options.image_path:
+            paths = [p.strip() for p in prompt.options.image_path.split(",") if p.strip()]
             try:
-                with open(image_path, 'rb') as img_file:
-                    encoded_image = base64.b64encode(img_file.read()).decode('utf-8')
-
-                messages.append({
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": prompt.prompt
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:{mime_type};base64,{encoded_image}"
-                            }
-                        }
-                    ]
-                })
+                images = get_image_cache().encode_many(paths, prompt.options.image_max_size)
             except (FileNotFoundError, OSError) as e:
                 raise llm.ModelError(f"Error processing image: {str(e)}")
+
+            content = [{"type": "text", "text": prompt.prompt}]
+            content.extend(
+                {"type": "image_url", "image_url": {"url": image["url"]}}
+                for image in images
+            )
+            messages.append({"role": "user", "content": content})
+            if metadata is not None:
+                metadata["images"] = [
+                    {k: v for k, v in image.items() if k != "url"} for image in images
+                ]
         else:
             messages.append({"role": "user", "content": prompt.prompt})
 
         return messages
 
+    def _compact_history(self, prompt, conversation, turns, metadata):
+        """
+        Apply the history option to prior (user, assistant) turns, returning
+        (summary, turns_to_replay).
+        """
+        strategy = prompt.options.history or "full"
+        if strategy == "full" or not turns:
+            return None, turns
+
+        budget = prompt.options.history_max_tokens
+        kept, used = 0, 0
+        for user_text, assistant_text in reversed(turns):
+            cost = estimate_tokens(user_text) + estimate_tokens(assistant_text)
+            if used + cost > budget:
+                break
+            used += cost
+            kept += 1
+        older, recent = turns[:len(turns) - kept], turns[len(turns) - kept:]
+
+        summary = None
+        if strategy == "summarize" and older:
+            summary = self._summarize_turns(prompt, conversation.id, older)
+            used += estimate_tokens(summary)
+
+        if metadata is not None:
+            full = sum(estimate_tokens(u) + estimate_tokens(a) for u, a in turns)
+            metadata["history"] = {
+                "strategy": strategy,
+                "turns": len(turns),
+                "turns_kept": len(recent),
+                "turns_summarized": len(older) if summary else 0,
+                "estimated_tokens": used,
+                "estimated_tokens_saved": full - used,
+            }
+        return summary, recent
+
+    def _summarize_turns(self, prompt, conversation_id, turns) -> str:
+        """
+        Summarize older turns with a cheap search-free request. Summaries are
+        stored per conversation and extended incrementally as more turns
+        roll out of the window.
+        """
+        store = get_summary_store()
+        covered, summary = store.latest(conversation_id, len(turns))
+        if covered == len(turns):
+            return summary
+
+        transcript = "\n\n".join(
+            f"User: {user_text}\nAssistant: {assistant_text}"
+            for user_text, assistant_text in turns[covered:]
+        )
+        if summary:
+            transcript = f"Summary so far:\n{summary}\n\nLater turns:\n{transcript}"
+
+        # Summaries always go out on the synchronous client, since
+        # build_messages is shared with the async model
+        api_key, base_url, _ = self.resolve_endpoint(prompt)
+        model_id = HISTORY_SUMMARY_MODEL
+        if prompt.options.use_openrouter:
+            model_id = f"perplexity/{model_id}"
+        completion = get_client_pool().get_client(api_key, base_url).chat.completions.create(
+            model=model_id,
+            messages=[
+                {"role": "system", "content": HISTORY_SUMMARY_PROMPT},
+                {"role": "user", "content": transcript},
+            ],
+            max_tokens=HISTORY_SUMMARY_MAX_TOKENS,
+            extra_body={"disable_search": True},
+        )
+        summary = completion.choices[0].message.content
+        store.save(conversation_id, len(turns), summary)
+        return summary
+
     def set_usage(self, response, usage):
         if not usage:
             return
@@ -333,7 +1300,8 @@ class Perplexity(llm.Model):
             return obj.citations
         return None
 
-    def execute(self, prompt, stream, response, conversation):
+    def resolve_endpoint(self, prompt):
+        """Return the (api_key, base_url, model_id) to call for this prompt."""
         if prompt.options.use_openrouter:
             if not any(p["name"] == "llm-openrouter" for p in llm.get_plugins()):
                 raise llm.ModelError(
@@ -341,18 +1309,13 @@ class Perplexity(llm.Model):
                     "Install it with: llm install llm-openrouter"
                 )
             api_key = llm.get_key("openrouter", "LLM_OPENROUTER_KEY")
-            base_url = "https://openrouter.ai/api/v1"
-            model_id = f"perplexity/{self.model_id}"
-        else:
-            api_key = self.get_key()
-            base_url = self.base_url
-            model_id = self.model_id
-
-        client = OpenAI(api_key=api_key, base_url=base_url)
+            return api_key, self.openrouter_base_url, f"perplexity/{self.model_id}"
+        return self.get_key(), self.base_url, self.model_id
 
+    def build_kwargs(self, prompt, conversation, stream, model_id, metadata=None) -> dict:
         kwargs = {
             "model": model_id,
-            "messages": self.build_messages(prompt, conversation),
+            "messages": self.build_messages(prompt, conversation, metadata),
             "stream": stream,
             "max_tokens": prompt.options.max_tokens or None,
         }
@@ -365,84 +1328,401 @@ class Perplexity(llm.Model):
         if prompt.options.stop:
             kwargs["stop"] = prompt.options.stop
 
-        # Perplexity-specific parameters go in extra_body since the
-        # openai client rejects non-standard kwargs
-        extra = {}
+        extra = build_extra_body(prompt.options)
+        if extra:
+            kwargs["extra_body"] = extra
+        return kwargs
 
-        if prompt.options.top_k:
-            extra["top_k"] = prompt.options.top_k
+    def _rate_limit_plan(self, prompt, base_url, kwargs):
+        """Return (limiter, estimated tokens, max retries) for a request."""
+        limiter = get_rate_limiter(base_url, kwargs["model"], prompt.options)
+        max_retries = prompt.options.max_retries
+        if max_retries is None:
+            max_retries = 2
+        return limiter, estimate_request_tokens(kwargs), max_retries
 
-        # Search parameters
-        if prompt.options.search_recency_filter:
-            extra["search_recency_filter"] = prompt.options.search_recency_filter
+    @staticmethod
+    def _record_rate_limit(metadata, limiter, waited, retries):
+        if limiter or retries:
+            metadata["rate_limit"] = {"wait_ms": round(waited * 1000), "retries": retries}
+
+    def _hedge_plan(self, prompt, base_url, kwargs):
+        """Return the hedge state for this model and endpoint, and the hedge delay."""
+        state = get_hedge_state(base_url, kwargs["model"])
+        state.record_request()
+        delay = prompt.options.hedge_delay or state.percentile(
+            prompt.options.hedge_percentile or HEDGE_DEFAULT_PERCENTILE
+        ) or HEDGE_DEFAULT_DELAY
+        return state, delay
 
-        if prompt.options.search_domain_filter:
-            domains = [d.strip() for d in prompt.options.search_domain_filter.split(",") if d.strip()]
-            if domains:
-                extra["search_domain_filter"] = ",".join(domains)
+    @staticmethod
+    def _record_hedge(metadata, state, winner, hedged, delay):
+        metadata["hedge"] = {
+            "hedged": hedged,
+            "winner": winner,
+            "delay_ms": round(delay * 1000),
+            "hedge_rate": round(state.hedge_rate, 4),
+        }
 
-        if prompt.options.search_type:
-            extra["web_search_options"] = {"search_type": prompt.options.search_type}
+    def _cache_key(self, prompt, kwargs) -> Optional[str]:
+        """Return the response cache key for this request, or None if caching is off."""
+        if prompt.options.no_cache:
+            return None
+        enabled = prompt.options.cache
+        if enabled is None:
+            enabled = os.environ.get("LLM_PERPLEXITY_CACHE", "").lower() in ("1", "true", "yes")
+        return ResponseCache.key(kwargs) if enabled else None
+
+    def _replay(self, prompt, response, entry, metadata=None) -> List[str]:
+        """Replay a cached entry as if it had just been received."""
+        response.response_json = dict(
+            entry["response_json"], cache={"hit": True, "age": round(entry["age"], 1)}
+        )
+        if metadata:
+            response.response_json.update(metadata)
+        self.set_usage(response, entry["usage"])
+        chunks = [entry["content"]]
+        if entry["citations"] and prompt.options.include_citations:
+            chunks.append(self.format_citations(entry["citations"]))
+        return chunks
+
+    def _finish(self, prompt, response, content, response_json, usage, citations, cache_key=None, metadata=None) -> str:
+        """Record a finished completion, returning the trailing citations text."""
+        response.response_json = remove_dict_none_values(response_json)
+        if metadata:
+            response.response_json.update(metadata)
+        self.set_usage(response, usage)
+        if cache_key:
+            get_response_cache().set(
+                cache_key,
+                {
+                    "content": content,
+                    "citations": citations or None,
+                    "usage": usage,
+                    "response_json": response.response_json,
+                },
+                prompt.options.cache_ttl or cache_ttl_for(prompt.options),
+            )
+        if citations and prompt.options.include_citations:
+            return self.format_citations(citations)
+        return ""
 
-        if prompt.options.search_mode:
-            extra["search_mode"] = prompt.options.search_mode
+    def __str__(self):
+        return f"Perplexity: {self.model_id}"
 
-        if prompt.options.disable_search:
-            extra["disable_search"] = prompt.options.disable_search
 
-        if prompt.options.search_language_filter:
-            extra["search_language_filter"] = prompt.options.search_language_filter
+class Perplexity(_SharedPerplexity, llm.Model):
+    def execute(self, prompt, stream, response, conversation):
+        api_key, base_url, model_id = self.resolve_endpoint(prompt)
+        metadata = {}
+        kwargs = self.build_kwargs(prompt, conversation, stream, model_id, metadata)
+        response._prompt_json = {"messages": kwargs["messages"]}
 
-        # Generation parameters
-        if prompt.options.reasoning_effort:
-            extra["reasoning_effort"] = prompt.options.reasoning_effort
+        cache_key = self._cache_key(prompt, kwargs)
+        if cache_key:
+            entry = get_response_cache().get(cache_key)
+            if entry:
+                yield from self._replay(prompt, response, entry, metadata)
+                return
 
-        if prompt.options.return_images:
-            extra["return_images"] = prompt.options.return_images
+        client = get_client_pool().get_client(api_key, base_url)
+        requests = self._request(prompt, client, base_url, kwargs, metadata)
+        if stream:
+            accumulator = StreamAccumulator()
 
-        if prompt.options.return_related_questions:
-            extra["return_related_questions"] = prompt.options.return_related_questions
+            for chunk in requests:
+                content = accumulator.add(chunk)
+                if content is not None:
+                    yield content
+            trailer = self._finish(
+                prompt, response, accumulator.content, accumulator.result(),
+                accumulator.usage, accumulator.citations, cache_key, metadata,
+            )
 
-        if prompt.options.language_preference:
-            extra["language_preference"] = prompt.options.language_preference
+        else:
+            (completion,) = requests
+            content = completion.choices[0].message.content
+            yield content
+            trailer = self._finish(
+                prompt, response, content, completion.model_dump(),
+                completion.usage.model_dump(), self._get_citations(completion), cache_key, metadata,
+            )
+        if trailer:
+            yield trailer
+
+    def _request(self, prompt, client, base_url, kwargs, metadata):
+        """
+        Yield the chunks of a streamed completion, or the single completion
+        object, after waiting for the rate limiter. Transient failures are
+        retried with backoff, but only until the first chunk has been yielded.
+        """
+        limiter, tokens, max_retries = self._rate_limit_plan(prompt, base_url, kwargs)
+        waited, retries = 0.0, 0
+        while True:
+            wait = limiter.reserve(tokens) if limiter else 0
+            if wait:
+                time.sleep(wait)
+                waited += wait
+            started = False
+            try:
+                completion = self._create(prompt, client, base_url, kwargs, metadata)
+                self._record_rate_limit(metadata, limiter, waited, retries)
+                if not kwargs["stream"]:
+                    started = True
+                    yield completion
+                    return
+                for chunk in completion:
+                    started = True
+                    yield chunk
+                return
+            except RETRYABLE_ERRORS as ex:
+                if started or retries >= max_retries:
+                    raise
+                delay = retry_delay(ex, retries)
+                retries += 1
+                time.sleep(delay)
+                waited += delay
+
+    def _create(self, prompt, client, base_url, kwargs, metadata):
+        """
+        Send the request. With hedging on, a second identical request is sent
+        if the first has not answered (or streamed its first chunk) within the
+        hedge delay; the first to finish wins and the other is discarded.
+        """
+        if not prompt.options.hedge:
+            return client.chat.completions.create(**kwargs)
+        state, delay = self._hedge_plan(prompt, base_url, kwargs)
+
+        def attempt():
+            start = time.monotonic()
+            completion = client.chat.completions.create(**kwargs)
+            if kwargs["stream"]:
+                completion = _PrefetchedStream(completion)
+            state.add(time.monotonic() - start)
+            return completion
+
+        executor = ThreadPoolExecutor(max_workers=2)
+        try:
+            attempts = [executor.submit(attempt)]
+            if not wait(attempts, timeout=delay).done and state.try_hedge(prompt.options.hedge_max_rate):
+                attempts.append(executor.submit(attempt))
+            winner, pending = None, set(attempts)
+            while pending and winner is None:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                winner = next((f for f in attempts if f in done and not f.exception()), None)
+        finally:
+            executor.shutdown(wait=False)
+        if winner is None:
+            raise attempts[0].exception()
+        for loser in attempts:
+            if loser is not winner:
+                # A blocking request can't be interrupted; a losing stream is
+                # closed as soon as it opens
+                loser.add_done_callback(_close_attempt)
+        self._record_hedge(metadata, state, attempts.index(winner), len(attempts) > 1, delay)
+        return winner.result()
+
+
+class AsyncPerplexity(_SharedPerplexity, llm.AsyncModel):
+    async def execute(self, prompt, stream, response, conversation):
+        api_key, base_url, model_id = self.resolve_endpoint(prompt)
+        metadata = {}
+        kwargs = self.build_kwargs(prompt, conversation, stream, model_id, metadata)
+        response._prompt_json = {"messages": kwargs["messages"]}
 
-        if extra:
-            kwargs["extra_body"] = extra
+        cache_key = self._cache_key(prompt, kwargs)
+        if cache_key:
+            entry = get_response_cache().get(cache_key)
+            if entry:
+                for chunk in self._replay(prompt, response, entry, metadata):
+                    yield chunk
+                return
 
+        client = get_client_pool().get_async_client(api_key, base_url)
+        requests = self._request(prompt, client, base_url, kwargs, metadata)
         if stream:
-            completion = client.chat.completions.create(**kwargs)
-            chunks = []
-            usage = None
-            citations = None
-
-            for chunk in completion:
-                chunks.append(chunk)
-                if hasattr(chunk, "usage") and chunk.usage:
-                    usage = chunk.usage.model_dump()
-                chunk_citations = self._get_citations(chunk)
-                if chunk_citations:
-                    citations = chunk_citations
-                try:
-                    content = chunk.choices[0].delta.content
-                except IndexError:
-                    content = None
+            accumulator = StreamAccumulator()
+
+            async for chunk in requests:
+                content = accumulator.add(chunk)
                 if content is not None:
                     yield content
-            response.response_json = remove_dict_none_values(Perplexity.combine_chunks(chunks))
-
-            if citations and prompt.options.include_citations:
-                yield self.format_citations(citations)
+            trailer = self._finish(
+                prompt, response, accumulator.content, accumulator.result(),
+                accumulator.usage, accumulator.citations, cache_key, metadata,
+            )
 
         else:
-            completion = client.chat.completions.create(**kwargs)
-            response.response_json = remove_dict_none_values(completion.model_dump())
-            usage = completion.usage.model_dump()
-            yield completion.choices[0].message.content
-            citations = self._get_citations(completion)
-            if citations and prompt.options.include_citations:
-                yield self.format_citations(citations)
-        self.set_usage(response, usage)
-        response._prompt_json = {"messages": kwargs["messages"]}
-
-    def __str__(self):
-        return f"Perplexity: {self.model_id}"
+            completion = await requests.__anext__()
+            await requests.aclose()
+            content = completion.choices[0].message.content
+            yield content
+            trailer = self._finish(
+                prompt, response, content, completion.model_dump(),
+                completion.usage.model_dump(), self._get_citations(completion), cache_key, metadata,
+            )
+        if trailer:
+            yield trailer
+
+    async def _request(self, prompt, client, base_url, kwargs, metadata):
+        """Async version of Perplexity._request."""
+        limiter, tokens, max_retries = self._rate_limit_plan(prompt, base_url, kwargs)
+        waited, retries = 0.0, 0
+        while True:
+            wait = limiter.reserve(tokens) if limiter else 0
+            if wait:
+                await asyncio.sleep(wait)
+                waited += wait
+            started = False
+            try:
+                completion = await self._create(prompt, client, base_url, kwargs, metadata)
+                self._record_rate_limit(metadata, limiter, waited, retries)
+                if not kwargs["stream"]:
+                    started = True
+                    yield completion
+                    return
+                async for chunk in completion:
+                    started = True
+                    yield chunk
+                return
+            except RETRYABLE_ERRORS as ex:
+                if started or retries >= max_retries:
+                    raise
+                delay = retry_delay(ex, retries)
+                retries += 1
+                await asyncio.sleep(delay)
+                waited += delay
+
+    async def _create(self, prompt, client, base_url, kwargs, metadata):
+        """Async version of Perplexity._create; the losing request is cancelled."""
+        if not prompt.options.hedge:
+            return await client.chat.completions.create(**kwargs)
+        state, delay = self._hedge_plan(prompt, base_url, kwargs)
+
+        async def attempt():
+            start = time.monotonic()
+            completion = await client.chat.completions.create(**kwargs)
+            if kwargs["stream"]:
+                completion = await _AsyncPrefetchedStream.start(completion)
+            state.add(time.monotonic() - start)
+            return completion
+
+        attempts = [asyncio.ensure_future(attempt())]
+        winner = None
+        try:
+            done, _ = await asyncio.wait(attempts, timeout=delay)
+            if not done and state.try_hedge(prompt.options.hedge_max_rate):
+                attempts.append(asyncio.ensure_future(attempt()))
+            pending = set(attempts)
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = next((t for t in attempts if t in done and not t.exception()), None)
+        finally:
+            losers = [task for task in attempts if task is not winner]
+            for task in losers:
+                task.cancel()
+            # Let cancelled attempts unwind, closing any stream that opened anyway
+            for result in await asyncio.gather(*losers, return_exceptions=True):
+                if isinstance(result, _AsyncPrefetchedStream):
+                    await result.close()
+        if winner is None:
+            raise attempts[0].exception()
+        self._record_hedge(metadata, state, attempts.index(winner), len(attempts) > 1, delay)
+        return winner.result()
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers, 0 for an empty list."""
+    if not values:
+        return 0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def read_batch_rows(path, input_format=None) -> List[dict]:
+    """Read batch prompts from a JSONL or CSV file."""
+    input_format = input_format or ("csv" if str(path).lower().endswith(".csv") else "jsonl")
+    with open(path, newline="", encoding="utf-8") as fp:
+        if input_format == "csv":
+            # Empty CSV cells mean "not set" rather than an empty string
+            return [{k: v for k, v in row.items() if v != ""} for row in csv.DictReader(fp)]
+        return [json.loads(line) for line in fp if line.strip()]
+
+
+def _completed_batch_indexes(output_path) -> set:
+    completed = set()
+    if os.path.exists(output_path):
+        with open(output_path, encoding="utf-8") as fp:
+            for line in fp:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A crash can leave a partially written final line
+                    continue
+                if "error" not in record:
+                    completed.add(record["index"])
+    return completed
+
+
+async def run_batch(rows, output_path, model_id="sonar", options=None, concurrency=8) -> dict:
+    """
+    Run batch rows through the async models with at most ``concurrency``
+    requests in flight, appending one JSON line per row as it completes.
+    """
+    completed = _completed_batch_indexes(output_path)
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    failed = 0
+
+    async def run_row(index, row, fp):
+        nonlocal failed
+        row = dict(row)
+        prompt_text = row.pop("prompt")
+        row_model_id = row.pop("model", model_id)
+        system = row.pop("system", None)
+        row_options = dict(options or {})
+        row_options.update(row.pop("options", {}))
+        row_options.update(row)
+        record = {"index": index, "model": row_model_id, "prompt": prompt_text}
+        async with semaphore:
+            start = time.monotonic()
+            try:
+                model = llm.get_async_model(row_model_id)
+                response = model.prompt(prompt_text, system=system, **row_options)
+                record["text"] = await response.text()
+                usage = await response.usage()
+                record["usage"] = {
+                    "input": usage.input, "output": usage.output, "details": usage.details,
+                }
+                citations = (await response.json() or {}).get("citations")
+                if citations:
+                    record["citations"] = citations
+            except Exception as ex:
+                failed += 1
+                record["error"] = str(ex)
+            duration = time.monotonic() - start
+            record["duration_ms"] = round(duration * 1000)
+            if "error" not in record:
+                latencies.append(duration)
+        fp.write(json.dumps(record) + "\n")
+        fp.flush()
+
+    start = time.monotonic()
+    with open(output_path, "a", encoding="utf-8") as fp:
+        await asyncio.gather(*(
+            run_row(index, row, fp)
+            for index, row in enumerate(rows)
+            if index not in completed
+        ))
+    elapsed = time.monotonic() - start
+    return {
+        "completed": len(latencies),
+        "failed": failed,
+        "skipped": len(completed),
+        "elapsed": elapsed,
+        "throughput": len(latencies) / elapsed if elapsed else 0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "max_ms": max(latencies, default=0) * 1000,
+    }
@@ -1,7 +1,11 @@
+import json
 import os
 import pytest
 import llm
 import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
 from PIL import Image, ImageDraw
 import dotenv
@@ -29,6 +33,110 @@ def temp_image():
 
     os.unlink(tmp_path)
 
+class _ChatCompletionsHandler(BaseHTTPRequestHandler):
+    """Minimal stand-in for the Perplexity chat completions endpoint."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.requests.append(body)
+        if self.server.delays:
+            time.sleep(self.server.delays.pop(0))
+        if self.server.failures:
+            status, headers = self.server.failures.pop(0)
+            payload = json.dumps({"error": {"message": "injected failure"}}).encode()
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+        base = {
+            "id": "test-id",
+            "model": body["model"],
+            "created": 1700000000,
+            "citations": ["https://example.com/a", "https://example.com/b"],
+        }
+        if body.get("stream"):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            pieces = ["Hello", " from", " the", " stub"]
+            for i, piece in enumerate(pieces):
+                chunk = dict(base, object="chat.completion.chunk", choices=[{
+                    "index": 0,
+                    "delta": {"role": "assistant", "content": piece},
+                    "finish_reason": "stop" if i == len(pieces) - 1 else None,
+                }])
+                if i == len(pieces) - 1:
+                    chunk["usage"] = {"prompt_tokens": 5, "completion_tokens": 4, "total_tokens": 9}
+                self._write_chunk(f"data: {json.dumps(chunk)}\n\n".encode())
+            self._write_chunk(b"data: [DONE]\n\n")
+            self._write_chunk(b"")
+        else:
+            payload = json.dumps(dict(base, object="chat.completion", choices=[{
+                "index": 0,
+                "message": {"role": "assistant", "content": "Hello from the stub"},
+                "finish_reason": "stop",
+            }], usage={"prompt_tokens": 5, "completion_tokens": 4, "total_tokens": 9})).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+
+@pytest.fixture
+def stub_server():
+    """Run a local chat completions server and point a model at it."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _ChatCompletionsHandler)
+    # Don't wait for keep-alive connections abandoned by cancelled requests
+    server.daemon_threads = True
+    server.block_on_close = False
+    server.requests = []
+    # (status, headers) responses to send before answering normally
+    server.failures = []
+    # Seconds to stall each request before responding
+    server.delays = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def stub_model(stub_server, monkeypatch):
+    from llm_perplexity import Perplexity, configure_client_pool
+    configure_client_pool()
+    model = Perplexity("sonar")
+    model.key = "test-key"
+    monkeypatch.setattr(model, "base_url", stub_server.url)
+    return model
+
+
+@pytest.fixture
+def async_stub_model(stub_server, monkeypatch):
+    from llm_perplexity import AsyncPerplexity, configure_client_pool
+    configure_client_pool()
+    model = AsyncPerplexity("sonar")
+    model.key = "test-key"
+    monkeypatch.setattr(model, "base_url", stub_server.url)
+    return model
+
+
 # Test standard models with parameterization
 @requires_api_key
 @pytest.mark.parametrize(
@@ -183,3 +291,293 @@ def test_openrouter_access():
 
     assert response is not None
     assert len(response.text()) > 0
+
+
+@pytest.mark.parametrize("stream", [True, False])
+def test_stub_server_prompt(stub_model, stream):
+    """Prompts against the local stand-in return text, citations and usage."""
+    response = stub_model.prompt("Hi", stream=stream)
+    text = response.text()
+    assert text.startswith("Hello from the stub")
+    assert "[1] https://example.com/a" in text
+    assert response.usage().input == 5
+    assert response.json()["citations"] == ["https://example.com/a", "https://example.com/b"]
+
+
+def test_client_pool_reuses_connections(stub_model):
+    """Sequential prompts share one client and one keep-alive connection."""
+    from llm_perplexity import get_client_pool
+    for _ in range(3):
+        stub_model.prompt("Hi", stream=False).text()
+    stats = get_client_pool().stats()
+    assert stats["clients"] == 1
+    assert stats["requests"] == 3
+    assert stats["connections_opened"] == 1
+    assert stats["connections_reused"] == 2
+
+
+def test_client_pool_keyed_by_key_and_url():
+    from llm_perplexity import ClientPool
+    pool = ClientPool()
+    assert pool.get_client("a", "http://x") is pool.get_client("a", "http://x")
+    assert pool.get_client("a", "http://x") is not pool.get_client("b", "http://x")
+    assert pool.stats()["clients"] == 2
+    pool.close()
+    assert pool.stats()["clients"] == 0
+
+
+def test_async_models_registered():
+    """Every model has an async twin."""
+    for model_id in ("sonar", "sonar-pro"):
+        assert str(llm.get_async_model(model_id)) == f"Perplexity: {model_id}"
+
+
+@pytest.mark.parametrize("stream", [True, False])
+def test_async_stub_server_prompt(async_stub_model, stream):
+    """The async model matches the sync model's text, citations and usage."""
+    import asyncio
+
+    async def run():
+        responses = [async_stub_model.prompt("Hi", stream=stream) for _ in range(10)]
+        texts = await asyncio.gather(*(r.text() for r in responses))
+        return responses, texts
+
+    responses, texts = asyncio.run(run())
+    for response, text in zip(responses, texts):
+        assert text.startswith("Hello from the stub")
+        assert "[2] https://example.com/b" in text
+        assert asyncio.run(response.usage()).output == 4
+
+
+def test_batch_command(stub_server, monkeypatch, tmp_path):
+    """Batch runs rows concurrently, keeps row indexes and resumes."""
+    from click.testing import CliRunner
+    from llm.cli import cli
+    from llm_perplexity import AsyncPerplexity, configure_client_pool
+    configure_client_pool()
+    monkeypatch.setenv("LLM_PERPLEXITY_KEY", "test-key")
+    monkeypatch.setattr(AsyncPerplexity, "base_url", stub_server.url)
+    input_path = tmp_path / "prompts.csv"
+    input_path.write_text("prompt,model,search_mode\nOne,,\nTwo,sonar-pro,academic\nThree,,\n")
+    output_path = tmp_path / "results.jsonl"
+    output_path.write_text(json.dumps({"index": 0, "text": "done before"}) + "\n")
+
+    result = CliRunner().invoke(cli, [
+        "perplexity", "batch", str(input_path), str(output_path), "-c", "2",
+    ])
+    assert result.exit_code == 0, result.output
+    assert "2 completed, 0 failed, 1 skipped" in result.output
+    records = [json.loads(line) for line in output_path.read_text().splitlines()]
+    assert sorted(r["index"] for r in records) == [0, 1, 2]
+    by_index = {r["index"]: r for r in records}
+    assert by_index[1]["model"] == "sonar-pro"
+    assert by_index[1]["text"].startswith("Hello from the stub")
+    assert by_index[2]["usage"]["input"] == 5
+    sent = {r["messages"][-1]["content"]: r for r in stub_server.requests}
+    assert set(sent) == {"Two", "Three"}
+    assert sent["Two"]["search_mode"] == "academic"
+
+
+def test_stream_accumulator_matches_combined_response():
+    """The accumulator builds the same response_json combine_chunks always did."""
+    from openai.types.chat import ChatCompletionChunk
+    from llm_perplexity import Perplexity, StreamAccumulator
+    raw = [
+        {"id": "x", "object": "chat.completion.chunk", "model": "sonar", "created": 1,
+         "citations": ["https://example.com"],
+         "choices": [{"index": 0, "delta": {"role": "assistant", "content": "Hel"}}]},
+        {"id": "x", "object": "chat.completion.chunk", "model": "sonar", "created": 1,
+         "choices": [{"index": 0, "delta": {"content": "lo"}, "finish_reason": "stop"}],
+         "usage": {"prompt_tokens": 1, "completion_tokens": 2, "total_tokens": 3}},
+    ]
+    chunks = [ChatCompletionChunk.model_validate(chunk) for chunk in raw]
+    accumulator = StreamAccumulator()
+    assert [accumulator.add(chunk) for chunk in chunks] == ["Hel", "lo"]
+    combined = accumulator.result()
+    assert combined == Perplexity.combine_chunks(chunks)
+    assert combined["content"] == "Hello"
+    assert combined["finish_reason"] == "stop"
+    assert combined["citations"] == ["https://example.com"]
+    assert combined["usage"]["completion_tokens"] == 2
+    assert combined["id"] == "x" and combined["created"] == 1
+
+
+@pytest.fixture
+def user_dir(tmp_path, monkeypatch):
+    """Keep the plugin's local database inside a temporary llm user dir."""
+    monkeypatch.setenv("LLM_USER_PATH", str(tmp_path / "llm"))
+    (tmp_path / "llm").mkdir()
+    return tmp_path / "llm"
+
+
+@pytest.mark.parametrize("stream", [True, False])
+def test_response_cache_replays_hits(stub_model, stub_server, user_dir, stream):
+    """Identical cached requests are served locally with citations and usage."""
+    from llm_perplexity import get_response_cache
+    first = stub_model.prompt("Hi", stream=stream, cache=True)
+    first_text = first.text()
+    second = stub_model.prompt("Hi", stream=not stream, cache=True)
+    assert second.text() == first_text
+    assert len(stub_server.requests) == 1
+    assert second.usage().input == 5
+    assert second.json()["cache"]["hit"] is True
+    assert second.json()["citations"] == first.json()["citations"]
+
+    stub_model.prompt("Hi", stream=stream, cache=True, no_cache=True).text()
+    stub_model.prompt("Hi", stream=stream).text()
+    assert len(stub_server.requests) == 3
+    stats = get_response_cache().stats()
+    assert (stats["entries"], stats["hits"], stats["misses"]) == (1, 1, 1)
+
+
+def test_response_cache_expiry_and_eviction(user_dir):
+    from llm_perplexity import PerplexityOptions, ResponseCache, cache_ttl_for
+    assert cache_ttl_for(PerplexityOptions(search_recency_filter="hour")) < cache_ttl_for(
+        PerplexityOptions(search_recency_filter="year")
+    )
+    cache = ResponseCache(max_entries=2)
+    cache.set("expired", {"content": "x"}, ttl=-1)
+    assert cache.get("expired") is None
+    for key in ("a", "b"):
+        cache.set(key, {"content": key}, ttl=60)
+    cache.get("a")
+    cache.set("c", {"content": "c"}, ttl=60)
+    assert cache.get("b") is None
+    assert cache.get("a")["content"] == "a"
+    assert ResponseCache.key({"model": "sonar", "stream": True}) == ResponseCache.key(
+        {"stream": False, "model": "sonar"}
+    )
+
+
+def test_image_pipeline(stub_model, stub_server, temp_image, tmp_path):
+    """Several images are sent per prompt, re-encoded only when changed and downscaled on request."""
+    from llm_perplexity import get_image_cache
+    large = tmp_path / "large.jpg"
+    Image.new("RGB", (2000, 1000), color="red").save(large)
+    paths = f"{temp_image}, {large}"
+
+    first = stub_model.prompt("Compare", stream=False, image_path=paths, image_max_size=500)
+    first.text()
+    content = stub_server.requests[-1]["messages"][-1]["content"]
+    assert [part["type"] for part in content] == ["text", "image_url", "image_url"]
+    images = first.json()["images"]
+    assert [image["cached"] for image in images] == [False, False]
+    assert images[1]["resized"] is True and not images[0]["resized"]
+    assert content[2]["image_url"]["url"].startswith("data:image/jpeg;base64,")
+
+    second = stub_model.prompt("Again", stream=False, image_path=paths, image_max_size=500)
+    second.text()
+    assert [image["cached"] for image in second.json()["images"]] == [True, True]
+    assert stub_server.requests[-1]["messages"][-1]["content"][1:] == content[1:]
+
+    resized = get_image_cache().encode(str(large), 500)
+    assert resized["encoded_bytes"] < get_image_cache().encode(str(large))["encoded_bytes"]
+
+
+@pytest.mark.parametrize("strategy", ["full", "window", "summarize"])
+def test_history_compaction(stub_model, stub_server, user_dir, strategy):
+    """Older turns are dropped or summarized once they exceed the token budget."""
+    conversation = stub_model.conversation()
+    for i in range(4):
+        conversation.prompt(f"Question {i} " + "x" * 200, stream=False).text()
+    options = {"history": strategy, "history_max_tokens": 150}
+    for _ in range(2):
+        response = conversation.prompt("Latest", stream=False, **options)
+        response.text()
+        messages = stub_server.requests[-1]["messages"]
+
+    users = [m["content"][:10] for m in messages if m["role"] == "user"]
+    summaries = [r for r in stub_server.requests if r.get("disable_search")]
+    if strategy == "full":
+        assert len(users) == 6
+        assert "history" not in response.json()
+        return
+    # Only the two newest turns fit in the budget
+    assert users == ["Question 3", "Latest", "Latest"]
+    history = response.json()["history"]
+    assert history["turns_kept"] == 2 and history["estimated_tokens_saved"] > 0
+    if strategy == "summarize":
+        assert messages[0]["role"] == "system"
+        assert "Hello from the stub" in messages[0]["content"]
+        assert history["turns_summarized"] == 3
+        # The second turn extends the stored summary of questions 0-1
+        # with question 2 instead of re-summarizing from the start
+        assert len(summaries) == 2
+        assert summaries[0]["model"] == "sonar"
+        later = summaries[1]["messages"][-1]["content"]
+        assert later.startswith("Summary so far") and "Question 0" not in later
+    else:
+        assert not summaries
+
+
+@pytest.mark.parametrize("stream", [True, False])
+def test_retries_rate_limits_and_server_errors(stub_model, stub_server, stream):
+    """429 and 5xx responses are retried, honouring Retry-After."""
+    stub_server.failures = [(429, {"Retry-After": "0.2"}), (503, {})]
+    response = stub_model.prompt("Hi", stream=stream, max_retries=2)
+    assert response.text().startswith("Hello from the stub")
+    assert len(stub_server.requests) == 3
+    rate_limit = response.json()["rate_limit"]
+    assert rate_limit["retries"] == 2
+    assert rate_limit["wait_ms"] >= 200
+
+
+def test_retries_give_up(stub_model, stub_server):
+    import openai
+    stub_server.failures = [(429, {"Retry-After": "0"})] * 2
+    with pytest.raises(openai.RateLimitError):
+        stub_model.prompt("Hi", stream=False, max_retries=1).text()
+    assert len(stub_server.requests) == 2
+
+
+def test_rate_limiter_spaces_requests(stub_model, stub_server):
+    """A requests-per-minute bucket makes callers wait once its burst is spent."""
+    from llm_perplexity import TokenBucket
+    bucket = TokenBucket(60)
+    assert bucket.reserve(60) == 0
+    assert bucket.reserve(1) == pytest.approx(1, abs=0.05)
+
+    response = stub_model.prompt("Hi", stream=False, requests_per_minute=6000)
+    response.text()
+    assert response.json()["rate_limit"] == {"wait_ms": 0, "retries": 0}
+
+
+@pytest.mark.parametrize("stream", [True, False])
+def test_hedged_request_beats_slow_attempt(stub_model, stub_server, stream):
+    """A stalled first attempt is overtaken by the hedge."""
+    stub_server.delays = [2.0]
+    start = time.monotonic()
+    response = stub_model.prompt(
+        "Hi", stream=stream, hedge=True, hedge_delay=0.1, hedge_max_rate=1.0
+    )
+    assert response.text().startswith("Hello from the stub")
+    assert time.monotonic() - start < 1.5
+    hedge = response.json()["hedge"]
+    assert hedge["hedged"] is True and hedge["winner"] == 1
+    assert len(stub_server.requests) == 2
+
+
+def test_hedge_rate_is_capped(stub_model, stub_server):
+    """With a zero hedge budget the slow attempt is simply awaited."""
+    stub_server.delays = [0.3]
+    response = stub_model.prompt("Hi", stream=False, hedge=True, hedge_delay=0.05, hedge_max_rate=0)
+    response.text()
+    assert response.json()["hedge"]["hedged"] is False
+    assert len(stub_server.requests) == 1
+
+
+def test_async_hedged_request(async_stub_model, stub_server):
+    import asyncio
+    stub_server.delays = [2.0]
+
+    async def run():
+        response = async_stub_model.prompt(
+            "Hi", stream=True, hedge=True, hedge_delay=0.1, hedge_max_rate=1.0
+        )
+        return await response.text(), await response.json()
+
+    start = time.monotonic()
+    text, response_json = asyncio.run(run())
+    assert text.startswith("Hello from the stub")
+    assert time.monotonic() - start < 1.5
+    assert response_json["hedge"]["winner"] == 1